@@ -20,7 +20,11 @@
 # along with Sardana.  If not, see <http://www.gnu.org/licenses/>.
 ##
 ##############################################################################
+import ast
+import json
 import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import numpy
 from sardana import State
 from sardana.pool.pooldefs import SynchDomain, SynchParam
@@ -35,7 +39,19 @@ HIGH = 'high'
 ECAM = 'ecam'
 
 MAX_ECAM_VALUES = 20477
-ECAM_SOURCE_VALUES = ['ENCIN', 'ABSENC', 'INPOS']
+# Resolution configuration parameters (step, turn) of each ecam source
+ECAM_SOURCE_CFG = {
+    'ENCIN': ('EINNSTEP', 'EINNTURN'),
+    'ABSENC': ('ABSNSTEP', 'ABSNTURN'),
+    'INPOS': ('INPNSTEP', 'INPNTURN'),
+}
+ECAM_SOURCE_VALUES = list(ECAM_SOURCE_CFG)
+TANGO_TIMEOUT = 3  # seconds
+MAX_RETRIES = 3
+MAX_ALIAS_WORKERS = 16
+MAX_RETRY_DELAY = 0.2  # seconds
+INT32_MIN = numpy.iinfo(numpy.int32).min
+INT32_MAX = numpy.iinfo(numpy.int32).max
 
 
 class IcePAPTriggerController(TriggerGateController):
@@ -73,8 +89,8 @@ class IcePAPTriggerController(TriggerGateController):
         },
         'EcamSource': {
             Type: str,
-            Description: 'dic "axis, pos_sel, polarity" e.g: '
-                         ' {44: "ENCIN"}'
+            Description: 'JSON dict "axis: pos_sel" e.g: '
+                         ' {"44": "ENCIN", "45": "TGTENC"}. '
                          'If the axis is not on the this list the syncpos '
                          'will use default value: AXIS,NORMAL',
             DefaultValue: ''
@@ -84,6 +100,20 @@ class IcePAPTriggerController(TriggerGateController):
             Description: 'Timeout used for the IcePAP socket communication',
             DefaultValue: 0.5
         },
+        'Retries': {
+            Type: int,
+            Description: 'Number of retries of the IcePAP communication, '
+                         'limited by the Timeout and the Tango timeout '
+                         '(3s). 0 means calculated from them. StateOne '
+                         'retries at most 3 times',
+            DefaultValue: 0
+        },
+        'PulseWidth': {
+            Type: float,
+            Description: 'Minimum width (s) of the trigger pulse generated '
+                         'when the synchronization is by time',
+            DefaultValue: 0.01
+        },
         'DefaultAxis': {
             Type: int, Description: 'Default axis used to generate triggers',
         }
@@ -112,90 +142,327 @@ class IcePAPTriggerController(TriggerGateController):
         self._time_mode = False
         self._start_trigger_only = False
         self._axis_info_list = list(map(str.strip, self.AxisInfos.split(',')))
-
-        # Calculate the number of retries according to the timeout and the
-        # default Tango timeout (3s)
-        self._retries_nr = 3 // (self.Timeout + 0.1)
-        if self._retries_nr == 0:
-            self._retries_nr = 1
-        self._retries_nr = int(self._retries_nr)
+        # InfoX commands used when the trigger is generated by the axis
+        self._axis_info_cmds = {}
+        for out in (LOW, HIGH, ECAM):
+            self._axis_info_cmds[out] = [
+                '{0} {1} NORMAL'.format(info_out, out).upper()
+                for info_out in self._axis_info_list]
+
+        self._retries_nr = self._get_retries_nr()
+        self._state_retries_nr = self._get_state_retries_nr()
         self._ipap = icepap.IcePAPController(host=self.Host, port=self.Port,
                                              timeout=self.Timeout)
         self._last_id = None
+        self._pmux_axis = None
         self._motor_axis = self.DefaultAxis
+        self._motor = None
+        if self._motor_axis is not None:
+            self._motor = self._ipap[self._motor_axis]
         self._motor_spu = 1
         self._is_tgtenc = False
-        self._ecam_source_dict = None
+        self._ecam_source_dict = {}
         self._ecam_source = "AXIS"
         self.setted = False
         self._moveable_on_input = {}
+        self._device_cache = {}
+        self._spu_cache = {}
+        self._spu_subscriptions = {}
+        self._resol_cache = {}
         if self.EcamSource:
-            self._ecam_source_dict = eval(self.EcamSource)
+            self._ecam_source_dict = self._parse_ecam_source(self.EcamSource)
+        # TGTENC sources are added once resolved by _load_motor_cfg
+        self._resolved_ecam_source = {
+            ecam_axis: enc for ecam_axis, enc in self._ecam_source_dict.items()
+            if enc != 'TGTENC'}
+
+    def _get_retries_nr(self):
+        """Return the number of retries of the IcePAP communication, limited
+        by the default Tango timeout.
+        """
+        # Calculate the number of retries according to the timeout and the
+        # default Tango timeout (3s)
+        retries_nr = max(1, int(TANGO_TIMEOUT / (self.Timeout + 0.1)))
+        if self.Retries > 0:
+            if self.Retries > retries_nr:
+                self._log.warning('Retries %d does not fit in the Tango '
+                                  'timeout, %d will be used', self.Retries,
+                                  retries_nr)
+            retries_nr = min(self.Retries, retries_nr)
+        return retries_nr
+
+    def _get_state_retries_nr(self):
+        """Return the number of retries of StateOne (max. MAX_RETRIES). The
+        retries and the backoff sleeps between them fit in the default Tango
+        timeout.
+        """
+        retries_nr = 1
+        elapsed = self.Timeout
+        delay = min(self.Timeout / 4, MAX_RETRY_DELAY)
+        while retries_nr < min(self._retries_nr, MAX_RETRIES):
+            elapsed += delay + self.Timeout
+            if elapsed > TANGO_TIMEOUT:
+                break
+            retries_nr += 1
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+        return retries_nr
+
+    def _parse_ecam_source(self, ecam_source):
+        """Parse the EcamSource property into a dict {axis: source}.
+
+        Sources are normalized to upper case and the not supported ones are
+        discarded, so the axis will use AXIS.
+        """
+        try:
+            sources = json.loads(ecam_source)
+        except ValueError:
+            # Backwards compatibility with the old format: {44: "ENCIN"}
+            try:
+                sources = ast.literal_eval(ecam_source)
+            except (ValueError, SyntaxError):
+                sources = None
+        if not isinstance(sources, dict):
+            self._log.error('EcamSource {!r} is not a dict, AXIS will be '
+                            'used for all the axes'.format(ecam_source))
+            return {}
+
+        ecam_source_dict = {}
+        for axis, enc in sources.items():
+            try:
+                axis = int(axis)
+                enc = enc.upper()
+            except (AttributeError, TypeError, ValueError):
+                self._log.error('EcamSource entry {!r}: {!r} not valid, '
+                                'ignored'.format(axis, enc))
+                continue
+            if enc != 'TGTENC' and enc not in ECAM_SOURCE_VALUES:
+                self._log.error('Ecam source {} of axis {} not supported, '
+                                'AXIS will be used'.format(enc, axis))
+                continue
+            ecam_source_dict[axis] = enc
+        return ecam_source_dict
 
     def _set_out(self, out=LOW, axis=0):
-        motor = self._ipap[self._motor_axis]
-        value = [out, 'normal']
+        motor = self._motor
+        if motor is None:
+            return
         if axis == 0:
-            motor.syncaux = value
-            if self._ecam_source_dict and \
-                    self._motor_axis in self._ecam_source_dict:
-                enc = self._ecam_source_dict[self._motor_axis].upper()
-                if enc == 'TGTENC':
-                    enc = motor.get_cfg('TGTENC')['TGTENC'].upper()
-                    self._ecam_source_dict[self._motor_axis] = enc
-                if enc in ECAM_SOURCE_VALUES:
-                    self._ecam_source = \
-                        self._ecam_source_dict[self._motor_axis]
-                else:
-                    self._log.error('Ecam source {} not supported, '
-                                    'AXIS will be used'.format(enc))
-                    self._ecam_source = "AXIS"
-            else:
-                self._ecam_source = "AXIS"
+            motor.syncaux = [out, 'normal']
+            self._ecam_source = self._resolved_ecam_source.get(
+                self._motor_axis, 'AXIS')
         else:
-            for info_out in self._axis_info_list:
-                setattr(motor, info_out, value)
+            for cmd in self._axis_info_cmds[out]:
+                motor.send_cmd(cmd)
 
-    def _configureMotor(self, id_, axis):
-        # this is a bit hacky, ideally we could define an extra attribute
-        # step_per_unit (would require updating it at the same time as the
-        # motor's one)
-        motor_name = "motor/{}/{}".format(self.IcepapCtrlAlias, id_)
-        motor = tango.DeviceProxy(motor_name)
-        self._motor_axis = id_
-        self._motor_spu = motor.read_attribute('step_per_unit').value
+    def _get_motor_name(self, id_):
+        # this is a bit hacky, ideally we should find a solution to
+        # not hardcode the model.
+        return "motor/{}/{}".format(self.IcepapCtrlAlias, id_)
+
+    def _get_motor_proxy(self, id_):
+        """Return the (cached) DeviceProxy of the Sardana motor of the axis.
+        """
+        motor = self._device_cache.get(id_)
+        if motor is None:
+            motor = tango.DeviceProxy(self._get_motor_name(id_))
+            self._device_cache[id_] = motor
+        return motor
+
+    def _on_spu_event(self, id_, event):
+        if event.err or event.attr_value is None:
+            self._spu_cache.pop(id_, None)
+        else:
+            self._spu_cache[id_] = event.attr_value.value
+            if id_ == self._motor_axis:
+                self._motor_spu = event.attr_value.value
+
+    def _get_motor_spu(self, id_):
+        """Return the step_per_unit of the Sardana motor of the axis.
+
+        The value is cached and kept up to date with the attribute change
+        events. If the motor does not push events it is read every time.
+        """
+        spu = self._spu_cache.get(id_)
+        if spu is not None:
+            return spu
+        motor = self._get_motor_proxy(id_)
+        spu = motor.read_attribute('step_per_unit').value
+        if id_ not in self._spu_subscriptions:
+            # The callback only keeps a weak reference to the controller, so
+            # the subscription does not keep it alive
+            ctrl = weakref.ref(self)
+
+            def callback(event):
+                ctrl_ = ctrl()
+                if ctrl_ is not None:
+                    ctrl_._on_spu_event(id_, event)
+
+            try:
+                event_id = motor.subscribe_event(
+                    'step_per_unit', tango.EventType.CHANGE_EVENT, callback)
+                self._spu_subscriptions[id_] = (motor, event_id)
+            except tango.DevFailed:
+                self._log.debug('step_per_unit of axis %s does not push '
+                                'change events, it will not be cached', id_)
+                self._spu_subscriptions[id_] = None
+        return spu
+
+    def _unsubscribe_spu_events(self):
+        subscriptions = self._spu_subscriptions
+        self._spu_subscriptions = {}
+        self._spu_cache = {}
+        for subscription in subscriptions.values():
+            if subscription is None:
+                continue
+            motor, event_id = subscription
+            try:
+                motor.unsubscribe_event(event_id)
+            except Exception:
+                self._log.debug('Can not unsubscribe from step_per_unit '
+                                'events of %s', motor)
+
+    def _load_motor_cfg(self):
+        """Read the axis configuration, resolve the TGTENC ecam source and
+        cache, per axis, the ecam source, the ratio between the ecam source
+        resolution and the motor resolution and the target encoder flag.
+
+        :return: the resolution ratio
+        """
+        # Read the whole axis configuration at once (one ?CFG command)
+        # instead of one request per parameter
+        cfg = self._motor.get_cfg()
+
+        # Check target encoder configuration to send ESYNC on StartOne
+        is_tgtenc = cfg['TGTENC'] == 'NONE'
+
+        enc = self._ecam_source_dict.get(self._motor_axis, 'AXIS')
+        if enc == 'TGTENC':
+            enc = cfg['TGTENC'].upper()
+            if enc not in ECAM_SOURCE_VALUES:
+                self._log.error('Ecam source {} not supported, '
+                                'AXIS will be used'.format(enc))
+                enc = 'AXIS'
+            self._resolved_ecam_source[self._motor_axis] = enc
+
+        # Calculation of the syncpos according to the selected encoder
+        ratio = 1
+        if enc != 'AXIS':
+            cfgstep, cfgturn = ECAM_SOURCE_CFG[enc]
+            enc_resol = int(cfg[cfgstep]) / int(cfg[cfgturn])
+            motor_resol = int(cfg['ANSTEP']) / int(cfg['ANTURN'])
+            ratio = enc_resol / motor_resol
 
+        self._resol_cache[self._motor_axis] = (enc, ratio, is_tgtenc)
+        self._ecam_source = enc
+        self._is_tgtenc = is_tgtenc
+        return ratio
+
+    def _configureMotor(self, id_, axis):
         if id_ == self._last_id:
+            # The step_per_unit is updated by the change events, read it
+            # only if it is not cached (no events or an error event)
+            if id_ not in self._spu_cache:
+                self._motor_spu = self._get_motor_spu(id_)
             return
-        self._last_id = id_
 
-        if axis == 0:
-            # remove previous connection and connect the new motor
-            pmux = self._ipap.get_pmux()
-            for p in pmux:
-                if 'E0' in p:
-                    self._ipap.clear_pmux('e0')
-                    break
-            self._ipap.add_pmux(self._motor_axis, 'e0', pos=False, aux=True,
-                                hard=True)
+        # The state changes below may fail half way, do not consider any
+        # axis configured until everything succeeded
+        self._last_id = None
 
-            pmux = self._ipap.get_pmux()
-            self._log.debug('_connectMotor PMUX={0}'.format(pmux))
+        # this is a bit hacky, ideally we could define an extra attribute
+        # step_per_unit (would require updating it at the same time as the
+        # motor's one)
+        self._motor_axis = id_
+        self._motor = self._ipap[id_]
+        self._motor_spu = self._get_motor_spu(id_)
+        # The active input changed, refresh its configuration
+        self._resol_cache.pop(id_, None)
+        cfg_loaded = True
+        try:
+            self._load_motor_cfg()
+        except Exception as e:
+            # Do not keep the previous axis values, SynchOne will read the
+            # configuration again
+            self._log.error('_configureMotor(%d).\nException:\n%s' %
+                            (id_, str(e)))
+            self._ecam_source = self._resolved_ecam_source.get(id_, 'AXIS')
+            self._is_tgtenc = False
+            cfg_loaded = False
+
+        if axis == 0 and self._pmux_axis != id_:
+            try:
+                self._connect_e0(id_)
+            except Exception:
+                # connect it again on the next call
+                self._pmux_axis = None
+                raise
+            self._pmux_axis = id_
+        # Only once everything succeeded, so a failure is retried on the
+        # next call
+        if cfg_loaded:
+            self._last_id = id_
+
+    def _connect_e0(self, id_):
+        """Connect the axis to the E0 multiplexer output, if it is not
+        already connected.
+        """
+        # E0 may be fed by more than one source
+        e0_sources = []
+        for p in self._ipap.get_pmux():
+            words = p.upper().split()
+            if 'E0' in words:
+                e0_sources.append(words)
+
+        if len(e0_sources) == 1:
+            e0 = e0_sources[0]
+            if 'HARD' in e0 and 'AUX' in e0 and 'POS' not in e0 \
+                    and ('B{}'.format(id_) in e0 or str(id_) in e0):
+                self._log.debug('_connectMotor axis {0} already connected '
+                                'to E0'.format(id_))
+                return
+
+        # remove previous connections and connect the new motor
+        if e0_sources:
+            self._ipap.clear_pmux('e0')
+        self._ipap.add_pmux(id_, 'e0', pos=False, aux=True, hard=True)
+        self._log.debug('_connectMotor axis {0} connected to E0'.format(id_))
+
+    def _resolve_alias(self, id_):
+        """Return the (alias, axis) of the Sardana motor of the axis or None
+        if the axis is not used by Sardana.
+        """
+        try:
+            return self._get_motor_proxy(id_).alias(), id_
+        except Exception:
+            self._device_cache.pop(id_, None)
+            self._log.error("Axis %s not used by Sardana (no alias)",
+                            self._get_motor_name(id_))
+            return None
 
     def AddDevice(self, axis):
         if axis == 0:
-            for i in self._ipap.find_axes():
-                # this is a bit hacky, ideally we should find a solution to
-                # not hardcode the model.
-                motor_name = "motor/{}/{}".format(self.IcepapCtrlAlias, i)
-                try:
-                    motor = tango.DeviceProxy(motor_name)
-                    alias = motor.alias()
-                    self._moveable_on_input[alias] = i
-                except Exception:
-                    self._log.error("Axis %s not used by Sardana (no "
-                                    "alias)", motor_name)
-                    pass
+            axes = self._ipap.find_axes()
+            moveable_on_input = {}
+            if axes:
+                # The alias queries are independent Tango calls, run them
+                # concurrently
+                workers = min(MAX_ALIAS_WORKERS, len(axes))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    results = list(executor.map(self._resolve_alias, axes))
+                for result in results:
+                    if result is not None:
+                        alias, i = result
+                        moveable_on_input[alias] = i
+            self._moveable_on_input = moveable_on_input
+
+    def DeleteDevice(self, axis):
+        if axis == 0:
+            self._unsubscribe_spu_events()
+
+    def __del__(self):
+        # __init__ may have failed before the subscriptions were created
+        if getattr(self, '_spu_subscriptions', None):
+            self._unsubscribe_spu_events()
 
     def StateOne(self, axis):
         """Get the trigger/gate state"""
@@ -203,13 +470,19 @@ class IcePAPTriggerController(TriggerGateController):
         hw_state = None
         state = State.On
         status = 'No synchronization in progress'
-        if self._motor_axis is not None:
-            for i in range(self._retries_nr):
+        if self._motor is not None:
+            delay = min(self.Timeout / 4, MAX_RETRY_DELAY)
+            for i in range(self._state_retries_nr):
                 try:
-                    hw_state = self._ipap[self._motor_axis].state
+                    hw_state = self._motor.state
                     break
                 except Exception:
                     self._log.error('State reading error retry: {0}'.format(i))
+                    if i < self._state_retries_nr - 1:
+                        # exponential backoff to not hammer a stalled
+                        # controller
+                        time.sleep(delay)
+                        delay = min(delay * 2, MAX_RETRY_DELAY)
 
             if hw_state is None or not hw_state.is_poweron():
                 state = State.Alarm
@@ -234,15 +507,17 @@ class IcePAPTriggerController(TriggerGateController):
     def StartOne(self, axis):
         """Overwrite the StartOne method"""
         if self._time_mode:
+            # there is not a firmware pulse for SYNCAUX/InfoX, keep the
+            # output high at least PulseWidth
             self._set_out(HIGH, axis)
-            time.sleep(0.01)
+            time.sleep(self.PulseWidth)
             self._set_out(LOW, axis)
             return
 
         if self._is_tgtenc:
             self._log.info('Send ESYNC to motor: %s',
-                           self._ipap[self._motor_axis].name)
-            self._ipap[self._motor_axis].esync()
+                           self._motor.name)
+            self._motor.esync()
 
     def AbortOne(self, axis):
         """Start the specified trigger"""
@@ -267,50 +542,18 @@ class IcePAPTriggerController(TriggerGateController):
 
         self._time_mode = False
 
-        # Check target encoder configuration to send ESYNC on StartOne
-        try:
-            tgtenc_cfg = \
-                self._ipap[self._motor_axis].get_cfg('TGTENC')['TGTENC']
-            self._is_tgtenc = tgtenc_cfg == 'NONE'
-        except Exception as e:
-            self._log.error('SynchOne(%d).\nException:\n%s' % (axis, str(e)))
-            return False
+        if self._motor_axis not in self._resol_cache:
+            try:
+                self._load_motor_cfg()
+            except Exception as e:
+                self._log.error('SynchOne(%d).\nException:\n%s' %
+                                (axis, str(e)))
+                return False
+        self._ecam_source, ratio, self._is_tgtenc = \
+            self._resol_cache[self._motor_axis]
 
         start_user = synch_group[SynchParam.Initial][SynchDomain.Position]
-        delta_user = synch_group[SynchParam.Total][SynchDomain.Position]
-
-        start = start_user * self._motor_spu
-        delta = delta_user * self._motor_spu
-
-        end = start + delta * nr_points
-
-        # Calculation of the syncpos according to the selected encoder
-        motor = self._ipap[self._motor_axis]
-        enc = self._ecam_source.upper()
-        if enc != 'AXIS':
-            if enc == 'ENCIN':
-                cfgstep = 'EINNSTEP'
-                cfgturn = 'EINNTURN'
-            elif enc == 'ABSENC':
-                cfgstep = 'ABSNSTEP'
-                cfgturn = 'ABSNTURN'
-            elif enc == 'INPOS':
-                cfgstep = 'INPNSTEP'
-                cfgturn = 'INPNTURN'
-            else:
-                cfgstep = 'ANSTEP'
-                cfgturn = 'ANTURN'
-
-            enc_resol = int(motor.get_cfg(cfgstep)[
-                            cfgstep])/int(motor.get_cfg(cfgturn)[cfgturn])
-            motor_resol = int(motor.get_cfg('ANSTEP')[
-                              'ANSTEP'])/int(motor.get_cfg('ANTURN')['ANTURN'])
-            start = (start / motor_resol) * enc_resol
-            delta = (delta / motor_resol) * enc_resol
-            end = (end / motor_resol) * enc_resol
-
-        self._log.debug('IcepapTriggerCtr configuration: %f %f %d %d' %
-                        (start, end, nr_points, delta))
+        start = start_user * self._motor_spu * ratio
 
         # There is a limitation of numbers of point on the icepap (20477)
         # ecamdat = motor.getAttribute('ecamdatinterval')
@@ -323,21 +566,44 @@ class IcePAPTriggerController(TriggerGateController):
         if self._start_trigger_only:
             trigger_table = numpy.array([start])
             self._log.debug('Start trigger only flag is active.')
+        elif nr_points < 1:
+            raise ValueError('The Trigger by position needs at least one '
+                             'position (point)')
         elif nr_points > MAX_ECAM_VALUES:
             msg = 'The Trigger by position not accept more than {0} ' \
                   'positions (points)'.format(MAX_ECAM_VALUES)
             raise RuntimeError(msg)
         else:
-            trigger_table = numpy.linspace(start, end - delta,
-                                           int(nr_points))
-            self._log.debug('Table generated by numpy.linspace({0},{1},'
-                            '{2})'.format(start, end-delta, nr_points))
+            delta_user = synch_group[SynchParam.Total][SynchDomain.Position]
+            delta = delta_user * self._motor_spu * ratio
+            end = start + delta * nr_points
+
+            self._log.debug('IcepapTriggerCtr configuration: %f %f %d %d' %
+                            (start, end, nr_points, delta))
+
+            if nr_points > 1 and abs(delta) < 1:
+                raise ValueError('The trigger positions are closer than one '
+                                 'step, the table would have repeated '
+                                 'positions')
+            # delta is not rounded to not accumulate the rounding error
+            trigger_table = start + delta * numpy.arange(int(nr_points))
+            self._log.debug('Table generated by {0} + {1} * numpy.arange('
+                            '{2})'.format(start, delta, nr_points))
+
+        # The ecam positions are steps: send them as integers (DWORD) to
+        # not lose precision with the single precision FLOAT. Round half up
+        # (not to even) so positions one step apart are never repeated.
+        trigger_table = numpy.floor(trigger_table + 0.5)
+        if trigger_table.min() < INT32_MIN or trigger_table.max() > INT32_MAX:
+            raise ValueError('The trigger positions are out of the IcePAP '
+                             'range')
+        trigger_table = trigger_table.astype(numpy.int32)
 
         table_loaded = False
         for i in range(self._retries_nr):
             try:
-                self._ipap[self._motor_axis].set_ecam_table(
-                    trigger_table, source=self._ecam_source)
+                self._motor.set_ecam_table(
+                    trigger_table, source=self._ecam_source, dtype='DWORD')
                 table_loaded = True
                 break
             except Exception:
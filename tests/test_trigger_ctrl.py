@@ -0,0 +1,491 @@
+import pytest
+
+
+@pytest.fixture
+def ctrl(mocker):
+    from sardana_icepap.ctrl.IcePAPTriggerController import \
+        IcePAPTriggerController
+
+    ctrl = IcePAPTriggerController.__new__(IcePAPTriggerController)
+    ctrl._log = mocker.MagicMock()
+    ctrl._ipap = mocker.MagicMock()
+
+    return ctrl
+
+
+@pytest.mark.parametrize(
+    "ecam_source",
+    ('{"44": "encin", "45": "TGTENC"}', '{44: "encin", 45: "TGTENC"}'),
+)
+def test_parse_ecam_source(ctrl, ecam_source):
+    result = ctrl._parse_ecam_source(ecam_source)
+
+    assert result == {44: "ENCIN", 45: "TGTENC"}
+    ctrl._log.error.assert_not_called()
+
+
+def test_parse_ecam_source_not_supported(ctrl):
+    result = ctrl._parse_ecam_source('{"44": "MOTOR", "45": "ABSENC"}')
+
+    assert result == {45: "ABSENC"}
+    ctrl._log.error.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "ecam_source",
+    (
+        '["ENCIN"]',
+        'not a dict',
+        '{"44": 1, "45": "ABSENC"}',
+        '{"mot": "ENCIN", "45": "ABSENC"}',
+    ),
+)
+def test_parse_ecam_source_not_valid(ctrl, ecam_source):
+    result = ctrl._parse_ecam_source(ecam_source)
+
+    assert result in ({}, {45: "ABSENC"})
+    ctrl._log.error.assert_called_once()
+
+
+def test_init(mocker):
+    from sardana_icepap.ctrl.IcePAPTriggerController import \
+        IcePAPTriggerController
+
+    ipap = mocker.patch("icepap.IcePAPController")
+    props = {
+        "Host": "icepap",
+        "Port": 5000,
+        "IcepapCtrlAlias": "ipap",
+        "AxisInfos": "InfoA, InfoB",
+        "EcamSource": '{"44": "encin", "45": "TGTENC"}',
+        "Timeout": 0.5,
+        "Retries": 0,
+        "PulseWidth": 0.01,
+        "DefaultAxis": 44,
+    }
+
+    ctrl = IcePAPTriggerController("ctrl", props)
+
+    ipap.assert_called_once_with(host="icepap", port=5000, timeout=0.5)
+    assert ctrl._motor is ipap.return_value.__getitem__.return_value
+    ipap.return_value.__getitem__.assert_called_once_with(44)
+    assert ctrl._ecam_source_dict == {44: "ENCIN", 45: "TGTENC"}
+    assert ctrl._resolved_ecam_source == {44: "ENCIN"}
+    assert ctrl._retries_nr == 5
+    assert ctrl._state_retries_nr == 3
+    assert ctrl._axis_info_cmds["ecam"] == [
+        "INFOA ECAM NORMAL", "INFOB ECAM NORMAL"]
+    assert ctrl._axis_info_cmds["low"] == [
+        "INFOA LOW NORMAL", "INFOB LOW NORMAL"]
+
+
+def test_get_motor_proxy_cached(mocker, ctrl):
+    device_proxy = mocker.patch("tango.DeviceProxy")
+    ctrl.IcepapCtrlAlias = "ipap"
+    ctrl._device_cache = {}
+
+    motor = ctrl._get_motor_proxy(1)
+
+    assert ctrl._get_motor_proxy(1) is motor
+    device_proxy.assert_called_once_with("motor/ipap/1")
+
+
+@pytest.fixture
+def spu_ctrl(mocker, ctrl):
+    ctrl._motor_axis = 5
+    ctrl._motor_spu = 1
+    ctrl._spu_cache = {}
+    ctrl._spu_subscriptions = {}
+    ctrl._get_motor_proxy = mocker.MagicMock()
+    motor = ctrl._get_motor_proxy.return_value
+    motor.read_attribute.return_value.value = 100
+    motor.subscribe_event.return_value = 7
+
+    return ctrl
+
+
+def spu_event(mocker, value=None, err=False):
+    event = mocker.MagicMock()
+    event.err = err
+    event.attr_value.value = value
+    return event
+
+
+def test_get_motor_spu_subscribes_once(spu_ctrl):
+    motor = spu_ctrl._get_motor_proxy.return_value
+
+    assert spu_ctrl._get_motor_spu(5) == 100
+    assert spu_ctrl._get_motor_spu(5) == 100
+
+    assert motor.read_attribute.call_count == 2
+    motor.subscribe_event.assert_called_once()
+    assert spu_ctrl._spu_subscriptions == {5: (motor, 7)}
+
+
+def test_get_motor_spu_no_events(spu_ctrl):
+    from tango import DevFailed
+
+    motor = spu_ctrl._get_motor_proxy.return_value
+    motor.subscribe_event.side_effect = DevFailed
+
+    assert spu_ctrl._get_motor_spu(5) == 100
+    assert spu_ctrl._get_motor_spu(5) == 100
+
+    motor.subscribe_event.assert_called_once()
+    assert spu_ctrl._spu_subscriptions == {5: None}
+
+
+def test_spu_events(mocker, spu_ctrl):
+    motor = spu_ctrl._get_motor_proxy.return_value
+    spu_ctrl._get_motor_spu(5)
+    callback = motor.subscribe_event.call_args[0][2]
+
+    callback(spu_event(mocker, 200))
+    assert spu_ctrl._spu_cache == {5: 200}
+    assert spu_ctrl._motor_spu == 200
+    assert spu_ctrl._get_motor_spu(5) == 200
+
+    callback(spu_event(mocker, err=True))
+    assert spu_ctrl._spu_cache == {}
+    # the value is read again after an error event
+    assert spu_ctrl._get_motor_spu(5) == 100
+
+
+def test_delete_device_unsubscribes(spu_ctrl):
+    motor = spu_ctrl._get_motor_proxy.return_value
+    spu_ctrl._get_motor_spu(5)
+
+    spu_ctrl.DeleteDevice(0)
+
+    motor.unsubscribe_event.assert_called_once_with(7)
+    assert spu_ctrl._spu_subscriptions == {}
+    assert spu_ctrl._spu_cache == {}
+
+
+def test_load_motor_cfg(ctrl):
+    ctrl._motor_axis = 44
+    ctrl._motor = ctrl._ipap[44]
+    ctrl._ecam_source_dict = {44: "ENCIN"}
+    ctrl._resol_cache = {}
+    ctrl._ipap[44].get_cfg.return_value = {
+        "TGTENC": "NONE",
+        "EINNSTEP": "4000",
+        "EINNTURN": "1",
+        "ANSTEP": "2000",
+        "ANTURN": "1",
+    }
+
+    assert ctrl._load_motor_cfg() == 2
+    assert ctrl._resol_cache == {44: ("ENCIN", 2, True)}
+    assert ctrl._ecam_source == "ENCIN"
+    assert ctrl._is_tgtenc
+    ctrl._ipap[44].get_cfg.assert_called_once_with()
+
+
+def test_set_out_axis_infos(mocker, ctrl):
+    ctrl._motor = mocker.MagicMock()
+    ctrl._axis_info_cmds = {"ecam": ["INFOA ECAM NORMAL", "INFOB ECAM NORMAL"]}
+
+    ctrl._set_out("ecam", 1)
+
+    ctrl._motor.send_cmd.assert_has_calls(
+        [mocker.call("INFOA ECAM NORMAL"), mocker.call("INFOB ECAM NORMAL")]
+    )
+
+
+@pytest.mark.parametrize(
+    ["pmux", "cleared", "added"],
+    (
+        [[], False, True],
+        [["HARD AUX B5 E0"], False, False],
+        [["HARD AUX B6 E0"], True, True],
+        [["HARD POS AUX B5 E0"], True, True],
+        [["HARD AUX B6 E0", "HARD AUX B5 E0"], True, True],
+        [["HARD AUX B5 E0", "HARD AUX B6 E0"], True, True],
+        [["HARD AUX B5 E1"], False, True],
+    ),
+)
+def test_connect_e0(ctrl, pmux, cleared, added):
+    ctrl._ipap.get_pmux.return_value = pmux
+
+    ctrl._connect_e0(5)
+
+    assert ctrl._ipap.clear_pmux.called == cleared
+    assert ctrl._ipap.add_pmux.called == added
+
+
+@pytest.fixture
+def synch_ctrl(mocker, ctrl):
+    ctrl._motor = mocker.MagicMock()
+    ctrl._motor_axis = 44
+    ctrl._motor_spu = 1
+    ctrl._ecam_source = "AXIS"
+    ctrl._resol_cache = {44: ("AXIS", 1, False)}
+    ctrl._start_trigger_only = False
+    ctrl._retries_nr = 1
+
+    return ctrl
+
+
+def synch_configuration(initial, total, repeats):
+    from sardana.pool.pooldefs import SynchDomain, SynchParam
+
+    return [
+        {
+            SynchParam.Initial: {SynchDomain.Position: initial},
+            SynchParam.Total: {SynchDomain.Position: total},
+            SynchParam.Repeats: repeats,
+        }
+    ]
+
+
+def test_synch_one_trigger_table(synch_ctrl):
+    synch_ctrl.SynchOne(1, synch_configuration(0.5, 1, 4))
+
+    args, kwargs = synch_ctrl._motor.set_ecam_table.call_args
+    assert args[0].tolist() == [1, 2, 3, 4]
+    assert args[0].dtype.name == "int32"
+    assert kwargs == {"source": "AXIS", "dtype": "DWORD"}
+
+
+def test_synch_one_repeated_positions(synch_ctrl):
+    with pytest.raises(ValueError):
+        synch_ctrl.SynchOne(1, synch_configuration(0, 0.5, 4))
+
+
+def test_load_motor_cfg_tgtenc(ctrl):
+    ctrl._motor_axis = 45
+    ctrl._motor = ctrl._ipap[45]
+    ctrl._ecam_source_dict = {45: "TGTENC"}
+    ctrl._resolved_ecam_source = {}
+    ctrl._resol_cache = {}
+    ctrl._ipap[45].get_cfg.return_value = {
+        "TGTENC": "absenc",
+        "ABSNSTEP": "1000",
+        "ABSNTURN": "1",
+        "ANSTEP": "2000",
+        "ANTURN": "1",
+    }
+
+    assert ctrl._load_motor_cfg() == 0.5
+    assert ctrl._ecam_source == "ABSENC"
+    assert ctrl._resolved_ecam_source == {45: "ABSENC"}
+    assert not ctrl._is_tgtenc
+
+
+def test_add_device_moveable_on_input(mocker, ctrl):
+    def alias(id_):
+        if id_ == 3:
+            raise Exception("no alias")
+        return "mot{}".format(id_)
+
+    ctrl._device_cache = {}
+    ctrl._ipap.find_axes.return_value = [1, 2, 3]
+    ctrl._get_motor_proxy = lambda id_: mocker.Mock(alias=lambda: alias(id_))
+
+    ctrl.IcepapCtrlAlias = "ipap"
+
+    ctrl.AddDevice(0)
+
+    assert ctrl._moveable_on_input == {"mot1": 1, "mot2": 2}
+    ctrl._log.error.assert_called_once_with(
+        "Axis %s not used by Sardana (no alias)", "motor/ipap/3")
+
+
+def test_configure_motor_same_axis(mocker, ctrl):
+    ctrl._last_id = 5
+    ctrl._spu_cache = {5: 2}
+    ctrl._get_motor_spu = mocker.MagicMock()
+
+    ctrl._configureMotor(5, 0)
+
+    ctrl._get_motor_spu.assert_not_called()
+    ctrl._ipap.get_pmux.assert_not_called()
+
+
+@pytest.fixture
+def configure_ctrl(mocker, ctrl):
+    ctrl._last_id = None
+    ctrl._pmux_axis = None
+    ctrl._motor_axis = None
+    ctrl._motor = None
+    ctrl._spu_cache = {}
+    ctrl._get_motor_spu = mocker.MagicMock(return_value=1)
+    ctrl._load_motor_cfg = mocker.MagicMock()
+    ctrl._ipap.get_pmux.return_value = []
+
+    return ctrl
+
+
+def test_configure_motor_cfg_error(configure_ctrl):
+    configure_ctrl._load_motor_cfg.side_effect = KeyError("TGTENC")
+
+    configure_ctrl._configureMotor(5, 0)
+
+    configure_ctrl._log.error.assert_called_once()
+    configure_ctrl._ipap.add_pmux.assert_called_once()
+    assert configure_ctrl._last_id is None
+
+    # the configuration is read again on the next call
+    configure_ctrl._load_motor_cfg.side_effect = None
+    configure_ctrl._configureMotor(5, 0)
+
+    assert configure_ctrl._load_motor_cfg.call_count == 2
+    assert configure_ctrl._last_id == 5
+
+
+def test_synch_one_no_positions(synch_ctrl):
+    with pytest.raises(ValueError, match="at least one position"):
+        synch_ctrl.SynchOne(1, synch_configuration(0, 1, 0))
+
+
+def test_synch_one_start_trigger_only(synch_ctrl):
+    from sardana.pool.pooldefs import SynchDomain, SynchParam
+
+    synch_ctrl._start_trigger_only = True
+    synch_ctrl._motor_spu = 2
+    synch_ctrl._resol_cache = {44: ("AXIS", 1.5, False)}
+    # Total is not needed when only the start trigger is used
+    configuration = [
+        {
+            SynchParam.Initial: {SynchDomain.Position: 0.7},
+            SynchParam.Repeats: 10,
+        }
+    ]
+
+    synch_ctrl.SynchOne(1, configuration)
+
+    args, kwargs = synch_ctrl._motor.set_ecam_table.call_args
+    assert args[0].tolist() == [round(0.7 * 2 * 1.5)]
+    assert args[0].dtype.name == "int32"
+    assert kwargs == {"source": "AXIS", "dtype": "DWORD"}
+
+
+@pytest.mark.parametrize(
+    ["retries", "timeout", "expected"],
+    (
+        [0, 0.5, 5],
+        [0, 1.4, 2],
+        [0, 5, 1],
+        [2, 0.5, 2],
+        [10, 0.5, 5],
+    ),
+)
+def test_get_retries_nr(ctrl, retries, timeout, expected):
+    ctrl.Retries = retries
+    ctrl.Timeout = timeout
+
+    assert ctrl._get_retries_nr() == expected
+    # the Retries property is limited by the Tango timeout
+    assert ctrl._log.warning.called == (retries > expected)
+
+
+@pytest.mark.parametrize(
+    ["retries_nr", "timeout", "expected"],
+    (
+        [5, 0.5, 3],
+        [2, 0.5, 2],
+        # 0.9 + 0.2 + 0.9 + 0.2 + 0.9 > 3s
+        [3, 0.9, 2],
+        [1, 5, 1],
+    ),
+)
+def test_get_state_retries_nr(ctrl, retries_nr, timeout, expected):
+    ctrl._retries_nr = retries_nr
+    ctrl.Timeout = timeout
+
+    assert ctrl._get_state_retries_nr() == expected
+
+
+def test_state_one_retries_backoff(mocker, ctrl):
+    from sardana import State
+
+    sleep = mocker.patch(
+        "sardana_icepap.ctrl.IcePAPTriggerController.time.sleep")
+    ctrl.Timeout = 0.5
+    ctrl._state_retries_nr = 4
+    ctrl._motor = mocker.MagicMock()
+    state = mocker.PropertyMock(side_effect=Exception("timeout"))
+    type(ctrl._motor).state = state
+
+    result = ctrl.StateOne(1)
+
+    assert result[0] == State.Alarm
+    assert state.call_count == 4
+    # no sleep after the last attempt
+    assert sleep.call_args_list == [
+        mocker.call(0.125), mocker.call(0.2), mocker.call(0.2)]
+
+
+def test_configure_motor_reselect_after_error(configure_ctrl):
+    configure_ctrl._configureMotor(1, 0)
+    assert configure_ctrl._last_id == 1
+
+    configure_ctrl._ipap.add_pmux.side_effect = Exception("pmux error")
+    with pytest.raises(Exception):
+        configure_ctrl._configureMotor(2, 0)
+    assert configure_ctrl._last_id is None
+
+    configure_ctrl._ipap.add_pmux.side_effect = None
+    configure_ctrl._configureMotor(1, 0)
+
+    assert configure_ctrl._motor_axis == 1
+    assert configure_ctrl._pmux_axis == 1
+    assert configure_ctrl._last_id == 1
+    assert configure_ctrl._ipap.add_pmux.call_count == 3
+    configure_ctrl._ipap.add_pmux.assert_called_with(
+        1, "e0", pos=False, aux=True, hard=True)
+
+
+def test_configure_motor_cfg_error_synch_one(mocker, ctrl):
+    cfg = {"TGTENC": "NONE"}
+    axes = {1: mocker.MagicMock(), 2: mocker.MagicMock()}
+    axes[1].get_cfg.side_effect = [cfg, Exception("timeout"), cfg]
+    axes[2].get_cfg.return_value = {"TGTENC": "ENCIN"}
+    ctrl._ipap.__getitem__.side_effect = lambda i: axes[i]
+    ctrl._ipap.get_pmux.return_value = []
+    ctrl._last_id = None
+    ctrl._pmux_axis = None
+    ctrl._motor_axis = None
+    ctrl._motor = None
+    ctrl._spu_cache = {}
+    ctrl._get_motor_spu = mocker.MagicMock(return_value=1)
+    ctrl._ecam_source_dict = {}
+    ctrl._resolved_ecam_source = {}
+    ctrl._resol_cache = {}
+    ctrl._start_trigger_only = True
+    ctrl._retries_nr = 1
+
+    ctrl._configureMotor(1, 0)
+    ctrl._configureMotor(2, 0)
+    assert not ctrl._is_tgtenc
+    ctrl._configureMotor(1, 0)
+    # the values of axis 2 are not kept
+    assert ctrl._resol_cache == {2: ("AXIS", 1, False)}
+    assert ctrl._ecam_source == "AXIS"
+    assert not ctrl._is_tgtenc
+
+    ctrl.SynchOne(1, synch_configuration(10, 1, 1))
+
+    assert axes[1].get_cfg.call_count == 3
+    assert ctrl._is_tgtenc
+    axes[1].set_ecam_table.assert_called_once()
+    axes[2].set_ecam_table.assert_not_called()
+
+
+def test_start_one_time_mode_pulse(mocker, ctrl):
+    manager = mocker.MagicMock()
+    mocker.patch(
+        "sardana_icepap.ctrl.IcePAPTriggerController.time.sleep",
+        manager.sleep)
+    ctrl._set_out = manager.set_out
+    ctrl._time_mode = True
+    ctrl.PulseWidth = 0.01
+
+    ctrl.StartOne(0)
+
+    assert manager.mock_calls == [
+        mocker.call.set_out("high", 0),
+        mocker.call.sleep(0.01),
+        mocker.call.set_out("low", 0),
+    ]